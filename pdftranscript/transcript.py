@@ -21,13 +21,17 @@ Get semantic HTML from PDFs converted by pdf2htmlEX.
 
 """
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from lxml.cssselect import CSSSelector
 from lxml.html import Element, fromstring, tostring
 from pdftranscript.ttf import pua_content  # , recover_text
 import collections
-import types
+import functools
+import operator
 import re
 import glob
 import os.path
+from pathlib import Path
 
 DEBUG = 0
 MIN_SPAN_SIZE = 8  # remove spans less than this width (in px)
@@ -36,6 +40,7 @@ TABLES = 1  # reconstruct tables
 # remove styles when done to show off the naked semantic HTML
 # and get ready for custom CSS, also removes paging data attributes
 STRIP_CSS = 1
+STRIP_ATTRS = ('style', 'id', 'class', 'data-page-no', 'data-data')
 BR = 1  # place break rules at original line endings
 REMOVE_HEADERS = 1
 BULLETS = ('•', '○', '■')  # list item bullets
@@ -63,6 +68,46 @@ try:
 except ImportError:
     print('config.py not found. Using default configuration.')
 
+
+def _union(patterns):
+    """Fuse patterns into one alternation so a single sub() pass
+    removes them all, instead of rescanning the document per pattern.
+    Leading global flags like (?s) are scoped to their own branch."""
+    branches = []
+    for p in patterns:
+        m = re.match(r'\(\?([aimsux]+)\)', p)
+        if m:
+            branches.append('(?%s:%s)' % (m.group(1), p[m.end() :]))
+        else:
+            branches.append('(?:%s)' % p)
+    return '|'.join(branches)
+
+
+# compile patterns once at import time (after config additions above)
+# to avoid re-parsing them for every document in a batch;
+# the whole pipeline works on bytes, from raw HTML to saved output
+_REMOVE_BEFORE_BYTES = re.compile(_union(REMOVE_BEFORE).encode(ENCODING))
+_REPLACE_AFTER_BYTES = [
+    (re.compile(a.encode(ENCODING)), b.encode(ENCODING)) for a, b in REPLACE_AFTER
+]
+_REMOVE_AFTER_BYTES = tuple(rm.encode(ENCODING) for rm in REMOVE_AFTER)
+_BULLET_BYTES = tuple(b.encode(ENCODING) for b in BULLETS if b)
+_PX_RE = re.compile(r'(\d{1,3}\.\d+)px;')
+
+# selectors compiled once; cssselect() would redo the CSS→XPath
+# translation and XPath compilation on every call
+_SEL_T = CSSSelector('.t', translator='html')
+_SEL_PC = CSSSelector('.pc', translator='html')
+_SEL_PC_FIRST = CSSSelector('.pc > *:first-child', translator='html')
+
+
+@functools.lru_cache(maxsize=1024)
+def _css(selector):
+    """Compile dynamic selectors like '.y1a' on first use; the same
+    positions recur across pages and similarly formatted documents."""
+    return CSSSelector(selector, translator='html')
+
+
 # pdf2htmlEX convention for CSS class names and corresponding properties
 CSS_CLASS_MAP = {
     '_': 'display:.*?',
@@ -100,21 +145,40 @@ def insert_after(e, a):
 
 def classn(class_, el):
     """Cut CSS class hex number out of HTML element's class attribute"""
-    return el.attrib['class'].split(' ' + class_)[1].split()[0]
+    rest = el.attrib['class'].partition(' ' + class_)[2]
+    end = rest.find(' ')
+    return rest if end < 0 else rest[:end]
 
 
-def css_sizes(class_, css):
-    """Scan CSS for specific rules and
-    return sorted class numbers and sizes."""
+_CLASS_RE = re.compile(r'(?:^| )([a-z_]+)([a-f0-9]+)')
+_CLASS_CACHE = {}
+
+
+def parse_classes(el):
+    """Parse an element's class attribute into a {prefix: hex number} dict.
+    Class strings repeat heavily across lines, so parses are cached."""
+    key = el.attrib.get('class', '')
+    parsed = _CLASS_CACHE.get(key)
+    if parsed is None:
+        parsed = dict(_CLASS_RE.findall(key))
+        _CLASS_CACHE[key] = parsed
+    return parsed
+
 
+@functools.lru_cache(maxsize=None)
+def _size_rule(class_):
+    """Compile the rule pattern for a class prefix once, for all documents."""
     property_ = CSS_CLASS_MAP[class_]
     px_value = r'(\d{1,3})(?:\.\d+)?px'
     hex_id = '([a-f0-9]{1,3})'
-    rule = r'\.%s%s{%s:%s;}' % (class_, hex_id, property_, px_value)
-    sizes = collections.OrderedDict()
-    for hex_, px_ in re.findall(rule, css):
-        sizes[hex_] = int(px_)
-    return sizes
+    return re.compile(r'\.%s%s{%s:%s;}' % (class_, hex_id, property_, px_value))
+
+
+def css_sizes(class_, css):
+    """Scan CSS for specific rules and
+    return sorted class numbers and sizes."""
+
+    return {hex_: int(px_) for hex_, px_ in _size_rule(class_).findall(css)}
 
 
 def wrap_set(dom, child_tag, parent_tag):
@@ -122,22 +186,20 @@ def wrap_set(dom, child_tag, parent_tag):
     - <li> in a <ul>
     - <tr> in a <table>
     """
-    nxt = 0
-    for e in dom.cssselect(child_tag):
-        if nxt != e:
+    box = None
+    for e in list(dom.iter(child_tag)):
+        # start a new container unless e directly follows the current one
+        if box is None or box.getnext() is not e:
             box = Element(parent_tag)
-            insert_after(box, e)
+            e.addprevious(box)
         box.append(e)
-        nxt = parent(e).getnext()
-        if nxt is None:
-            nxt = e.getnext()
 
 
 def remove_headers(dom):
     leading = []  # collect topmost tags on each page and their joined text
-    for n1 in dom.cssselect('.pc > *:first-child'):  # for each 1st tag on page
+    for n1 in _SEL_PC_FIRST(dom):  # for each 1st tag on page
         n1_y = classn('y', n1)  # get its top position
-        topmost = parent(n1).cssselect('.y' + n1_y)  # select same top positions
+        topmost = _css('.y' + n1_y)(parent(n1))  # select same top positions
         header_txt = ' '.join([x.text_content() for x in topmost])
         # strip all numbers (including page numbers)
         header_txt = ''.join(a for a in header_txt if not a.isdigit()).strip()
@@ -155,15 +217,35 @@ def remove_headers(dom):
     return dom
 
 
+class Line:
+    """One text line (.t div) with its resolved page and coordinates.
+    Slotted; thousands get allocated per document."""
+
+    __slots__ = ('page', 'x', 'y', 'key', 'elem', 'clipbox', 'lines', 'text')
+
+    def __init__(self, page, x, y, elem, clipbox, text):
+        self.page = page
+        self.x = x
+        self.y = y
+        self.key = (page, y, x)  # vertical-then-horizontal sort order
+        self.elem = elem
+        self.clipbox = clipbox
+        self.lines = []
+        self.text = text
+
+
 def grid_data(dom, get_dimension):
+    # map lines to page numbers upfront, one pass per page container,
+    # instead of walking up the ancestors of every single line
+    line_to_page = {}
+    for pc in _SEL_PC(dom):
+        page = int(classn('pc', pc), 16)
+        for line in _SEL_T(pc):
+            line_to_page[line] = page
+
     data = []
-    for l in dom.cssselect('.t'):  # noqa: E741, l means line
-        # get page number of the current page
-        page = 0
-        for anc in l.iterancestors():
-            if anc.attrib.get('class', '').startswith('pc '):
-                page = int(classn('pc', anc), 16)
-                break
+    for l in _SEL_T(dom):  # noqa: E741, l means line
+        page = line_to_page.get(l, 0)  # page number of the current page
         # collect elements and their coordinates for ordering
         # if text box (.t) has a parent clip box (.c)
         # this affects actual coordinates
@@ -181,8 +263,7 @@ def grid_data(dom, get_dimension):
 
         paper_height = 850  # height of A4 page in px
         y = paper_height - y  # turn bottom position into top
-        ns = types.SimpleNamespace(page=page, x=x, y=y, elem=l, clipbox=cb, lines=[], text=l.text)
-        data.append(ns)
+        data.append(Line(page, x, y, l, cb, l.text))
     return data
 
 
@@ -190,7 +271,7 @@ def reconstruct_tables(dom, data):
     # order data vertically into row lists by page, row and finally column
     rows = collections.OrderedDict()
     cboxes = {}
-    for c in sorted(data, key=lambda c: (c.page, c.y, c.x)):
+    for c in sorted(data, key=operator.attrgetter('key')):
         # combine page number and row position to get a useful key
         key = f'{c.page:d},{c.y:d}'
         # create row lists(y) and clip-box groups(x)
@@ -201,14 +282,17 @@ def reconstruct_tables(dom, data):
     # pprint(rows)
 
     # collect cell lines with same clip boxes
-    merged = []
+    merged = set()
     for key, row in rows.items():
+        keep = []
         for cell in row:
-            if cell.clipbox in merged:
-                rows[key] = [c for c in rows[key] if c != cell]
-            else:
-                cell.lines = cboxes[cell.clipbox]
-                merged.append(cell.clipbox)
+            cb = cell.clipbox
+            if cb in merged:  # lines of this clip box already collected
+                continue
+            cell.lines = cboxes[cb]
+            merged.add(cb)
+            keep.append(cell)
+        rows[key] = keep
 
     for row in rows.values():
         # hardly a table row if there is only one
@@ -226,9 +310,9 @@ def reconstruct_tables(dom, data):
                     cell.elem.append(line)
                 tr.append(cell.elem)
     # drop empty span, divs
-    for e in dom.iter():
+    for e in list(dom.iter('span', 'div')):  # tag filtering happens in C
         text = e.text_content()
-        if e.tag in ('span', 'div') and not text or text == ' ':
+        if not text or text == ' ':
             e.drop_tag()
 
     wrap_set(dom, 'tr', 'table')
@@ -236,35 +320,40 @@ def reconstruct_tables(dom, data):
 
 
 def prepare(doc_path):
-    s = open(doc_path, 'rt', encoding=ENCODING).read()
+    # work on raw bytes: lxml prefers them and regex cleanup
+    # then needs no decode/encode round trip of the whole file
+    s = Path(doc_path).read_bytes()
     css_path = doc_path.replace('.html', '.css')
-    css = open(css_path, 'rt', encoding=ENCODING).read()
+    css = Path(css_path).read_text(encoding=ENCODING)
 
-    for rm in REMOVE_BEFORE:
-        s = re.sub(rm, '', s)
+    s = _REMOVE_BEFORE_BYTES.sub(b'', s)
 
     # round pixel sizes to whole pixels
-    for no in re.findall(r'(\d{1,3}\.\d{6})px;', css):
-        css = css.replace(no, str(int(round(float(no)))))
+    css = _PX_RE.sub(lambda m: str(int(round(float(m.group(1))))) + 'px;', css)
 
     dimensions = {x: css_sizes(x, css) for x in '_ fs h x y'.split()}
 
-    # remove spacing spans of very small width
-    span_sizes = dimensions['_'].items()
-    for no, size in span_sizes:
-        if int(size) < MIN_SPAN_SIZE:
-            span = f'<span class="_ _{no}"> </span>'
-            s = s.replace(span, '')
+    # remove spacing spans of very small width, all in one pass
+    small = [no for no, size in dimensions['_'].items() if size < MIN_SPAN_SIZE]
+    if small:
+        spans = r'<span class="_ _(?:%s)"> </span>' % '|'.join(map(re.escape, small))
+        s = re.sub(spans.encode(ENCODING), b'', s)
 
     dom = fromstring(s)
     return dom, dimensions
 
 
 def heading_levels(dom, dimensions):
+    # count font-size(fs) classes in a single pass over the tree
+    # rather than one full selector query per known size
+    fs_counts = collections.Counter()
+    for e in dom.iter():
+        if e.get('class'):
+            fs = parse_classes(e).get('fs')
+            if fs:
+                fs_counts[fs] += 1
     # find most common font-size(fs), font-sizes bigger than that are headings
-    fs_stats = [
-        (len(dom.cssselect('.fs' + cssn)), cssn, fs) for cssn, fs in dimensions['fs'].items()
-    ]
+    fs_stats = [(fs_counts[cssn], cssn, fs) for cssn, fs in dimensions['fs'].items()]
     top_stats = sorted(fs_stats, key=lambda x: x[0], reverse=True)
     prevalent_fs = top_stats[0][-1]
     headings = [x for x in reversed(fs_stats) if x[-1] > prevalent_fs]
@@ -287,7 +376,7 @@ def semanticize(doc_path='test.html'):
     dom, dimensions = prepare(doc_path)
 
     def get_dimension(el, dim_type):
-        return dimensions[dim_type].get(classn(dim_type, el)) or 0
+        return dimensions[dim_type].get(parse_classes(el).get(dim_type)) or 0
 
     # recover text from embedded fonts with bad CMAPS
     # if > 50% of characters are UNICODE Private Use Area
@@ -302,8 +391,9 @@ def semanticize(doc_path='test.html'):
         dom = remove_headers(dom)
 
     # remove javascript holders
-    for div in dom.cssselect('.j'):
-        remove(div)
+    for div in list(dom.iter('div')):
+        if 'j' in (div.get('class') or '').split():
+            remove(div)
 
     if TABLES:
         table_data = grid_data(dom, get_dimension)
@@ -314,7 +404,7 @@ def semanticize(doc_path='test.html'):
     # line by line analysis and conversion
     p_look = p_height = p_space = p_tag = box = 0
 
-    for l in dom.cssselect('.t'):  # noqa: E741, l means line
+    for l in _SEL_T(dom):  # noqa: E741, l means line
         # Gather information about this line to see if it's part of a block.
         # 1. detect change of look - different css classes from previous line
         classes = l.attrib['class'].split()
@@ -346,8 +436,8 @@ def semanticize(doc_path='test.html'):
             tag = 'li'
             append = 1
         # H1, H2...
-        size = classn('fs', l)
-        if size in h_levels.keys():
+        size = parse_classes(l).get('fs')
+        if size in h_levels:
             append = 0
             tag = f'h{h_levels[size]}'
 
@@ -376,45 +466,44 @@ def semanticize(doc_path='test.html'):
     wrap_set(dom, 'li', 'ul')
 
     if STRIP_CSS:
-        for e in dom.cssselect('style'):
+        for e in list(dom.iter('style')):
             remove(e)
-        for attr in 'style id class data-page-no data-data'.split():
-            for e in dom.cssselect('*'):
-                try:
-                    del e.attrib[attr]
-                except KeyError:
-                    pass
-
-    # save file
-    html = tostring(dom, encoding=ENCODING, pretty_print=True).decode(ENCODING)
-    s = '<!DOCTYPE html>' + html
-    for a, b in REPLACE_AFTER:
-        s = re.sub(a, b, s)
-    for rm in REMOVE_AFTER:
-        s = re.sub(rm, '', s)
-    for b in BULLETS:
-        s = s.replace(b, '')
+        for e in dom.iter():
+            attrs = e.attrib
+            for attr in STRIP_ATTRS:
+                attrs.pop(attr, None)
+
+    # save file; serialize compact - the output feeds further pipelines,
+    # pretty printing would only inflate it and the cleanup passes below
+    out = b'<!DOCTYPE html>' + tostring(dom, encoding=ENCODING)
+    for a, b in _REPLACE_AFTER_BYTES:
+        out = a.sub(b, out)
+    for rm in _REMOVE_AFTER_BYTES:  # literal strings, no regex engine needed
+        out = out.replace(rm, b'')
+    for b in _BULLET_BYTES:
+        out = out.replace(b, b'')
     if recover:
-        for rm in REMOVE_BEFORE:
-            s = re.sub(rm, '', s)
+        out = _REMOVE_BEFORE_BYTES.sub(b'', out)
     save_path = os.path.dirname(doc_path.replace('HTML', 'HTM')) + '.htm'
-    f = open(save_path, 'w', encoding=ENCODING)
-    f.write(s)
-    f.close()
-
-
-def batch_process(docs, limit=None):
-    for i, path in enumerate(glob.glob(docs)):
-        if i == limit:
-            break
-        try:
-            semanticize(path)
-        except Exception as e:
-            print(e)
-            import traceback
-
-            print(traceback.format_exc())
-            continue
+    tmp_path = save_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(out)
+    os.replace(tmp_path, save_path)  # atomic, no partial files on a crash
+
+
+def batch_process(docs, limit=None, workers=None):
+    """Convert documents on all CPU cores; each one is independent."""
+    paths = list(glob.iglob(docs))[:limit]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {pool.submit(semanticize, path): path for path in paths}
+        for job in as_completed(jobs):
+            try:
+                job.result()
+            except Exception as e:
+                print(jobs[job], e)
+                import traceback
+
+                print(traceback.format_exc())
 
 
 if __name__ == '__main__':